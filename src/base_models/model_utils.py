@@ -11,6 +11,7 @@ Aron Schmied (aronsch@student.ethz.ch)
 Guney Tombak (gtombak@student.ethz.ch)  
 """
 
+import torch
 import torch.nn as nn
 import torch.nn.init as init
 
@@ -27,3 +28,8 @@ def kaiming_init(net):
             if module.bias is not None:
                 module.bias.data.fill_(0)
 
+
+def autocast(device):
+    """Mixed precision context, enabled only on GPU"""
+    device_type = torch.device(device).type
+    return torch.autocast(device_type, enabled=(device_type == 'cuda'))
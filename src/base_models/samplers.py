@@ -12,14 +12,16 @@ Guney Tombak (gtombak@student.ethz.ch)
 """
 
 import torch.nn as nn
-from scipy.special import kl_div
 import numpy as np
 import torch
 from tqdm import tqdm
 from torch import optim
-from .model_utils import kaiming_init
-from torch.nn.functional import normalize
-from sklearn.decomposition import PCA
+from .model_utils import kaiming_init, autocast
+
+try: # faiss is only required for the approximate neighbour search of CAL samplers
+    import faiss
+except ImportError:
+    faiss = None
 
 
 class BaseSampler(nn.Module):
@@ -28,8 +30,10 @@ class BaseSampler(nn.Module):
         super(BaseSampler, self).__init__()
         self.cfg_smp = cfg_smp
         self.dev = device
-        self.batch_size = 20 # not to confuse with #neighbors and #classes
+        self.batch_size = cfg_smp.get('batch_size', 128) # inference batch size, not to confuse with #neighbors and #classes
         self.trainable = False
+        # inverse temperature for stochastic acquisition (None: deterministic top-k acquisition)
+        self.beta = cfg_smp.get('beta')
 
     def sample(self, active_data, acq_size, model):
         raise NotImplementedError()
@@ -37,12 +41,26 @@ class BaseSampler(nn.Module):
     def forward(self):
         return 0.0
 
+    def acquire(self, score, acq_size):
+        """
+        Returns the indices of the acq_size samples to be acquired according to their scores.
+        Without beta, the samples with the highest scores are taken; otherwise the samples are drawn 
+        without replacement with probabilities softmax(beta * score) using the Gumbel-top-k trick.
+        """
+        if self.beta is not None:
+            gumbel = -torch.empty_like(score).exponential_().log()
+            score = self.beta * score + gumbel
+        _, querry_indices = torch.topk(score, acq_size, sorted=False)
+        return querry_indices
+
 class TrainableSampler(BaseSampler):
     """Parent Sampler class for the samplers require training"""
     def __init__(self, cfg_smp, device):
         super(TrainableSampler, self).__init__(cfg_smp, device)
         self.trainable = True
         self.n_sub_epochs = cfg_smp['n_sub_epochs']
+        # number of steps whose gradients are accumulated before an optimizer step
+        self.n_accum_steps = cfg_smp.get('n_accum_steps', 1)
 
         self.optimizer = None
 
@@ -60,20 +78,56 @@ class Random(BaseSampler):
 
     def sample(self, active_data, acq_size, model):
         # indices of unlabeled indices in the training
-        unlbld_idx = torch.where(torch.logical_not(active_data.lbld_mask))[0]
+        unlbld_idx = active_data.unlbld_idx
         # selecting randomly from the unlabeled without replacing
         sample_idx = np.random.choice(len(unlbld_idx), acq_size, replace=False)
         return unlbld_idx[sample_idx]
 
+def faiss_index(A, n_links=32):
+    """
+    Builds an approximate nearest neighbour (HNSW, l2) index of FAISS 
+    A       : possible neighbours (N_A, D)
+    n_links : number of links per node in the HNSW graph
+    """
+    A = A.detach().cpu().numpy().astype(np.float32)
+    index = faiss.IndexHNSWFlat(A.shape[1], n_links)
+    index.add(A)
+    return index
+
+
+def check_neigh_search(cfg_smp, neigh_dist='l2'):
+    """Returns the neighbour search type (exact/faiss) of CAL samplers after checking its requirements"""
+    neigh_search = cfg_smp.get('neigh_search', 'exact')
+    if neigh_search == 'faiss':
+        if faiss is None:
+            raise ImportError("cfg_smp.neigh_search set to faiss but faiss is not installed")
+        if neigh_dist != 'l2':
+            raise ValueError("cfg_smp.neigh_search faiss only supports l2 as cfg_smp.neigh_dist")
+    elif neigh_search != 'exact':
+        raise ValueError("cfg_smp.neigh_search set to {} which is not known".format(neigh_search))
+    return neigh_search
+
+
+def kl_div(y_l, y_p):
+    """
+    Elementwise KL divergence terms y_l*log(y_l/y_p) - y_l + y_p (as scipy.special.kl_div) 
+    computed on the device of the inputs; 0 for y_l = y_p = 0 and inf for y_l > 0, y_p = 0
+    """
+    return torch.xlogy(y_l, y_l) - torch.xlogy(y_l, y_p) - y_l + y_p
+
+
+@torch.jit.script # scripted to fuse the elementwise operations
 def gaussian_kl_div(mu_p, log_var_p, mu_q, log_var_q):
-    """KL(Q||P) where Q, P ~ N(mu_1:k, diag(sigma2_1:k))"""
-    return 0.5*(torch.exp(-log_var_q)*(torch.exp(log_var_p) + (mu_q-mu_p)**2) - 1 + log_var_q - log_var_p).sum(1)
+    """KL(Q||P) where Q, P ~ N(mu_1:k, diag(sigma2_1:k)), summed over the last (latent) dimension"""
+    return 0.5*(torch.exp(log_var_p - log_var_q) + (mu_q - mu_p).square()*torch.exp(-log_var_q)
+                + log_var_q - log_var_p - 1).sum(-1)
 
 
+@torch.jit.script # scripted to fuse the elementwise operations
 def gaussian_symmetric_kl_div(mu_p, log_var_p, mu_q, log_var_q):
-    """KL(Q||P)-KL(P||Q) where Q, P ~ N(mu_1:k, diag(sigma2_1:k))"""
-    return 0.5*(torch.exp(-log_var_q)*(torch.exp(log_var_p) + (mu_q-mu_p)**2)
-                + torch.exp(-log_var_p)*(torch.exp(log_var_q) + (mu_p-mu_q)**2) -2).sum(1)
+    """KL(Q||P)-KL(P||Q) where Q, P ~ N(mu_1:k, diag(sigma2_1:k)), summed over the last (latent) dimension"""
+    return 0.5*(torch.exp(log_var_p - log_var_q) + torch.exp(log_var_q - log_var_p)
+                + (mu_q - mu_p).square()*(torch.exp(-log_var_q) + torch.exp(-log_var_p)) - 2).sum(-1)
 
 
 class CAL(BaseSampler):
@@ -86,79 +140,116 @@ class CAL(BaseSampler):
         # number of neighbours to be considered
         self.n_neighs = cfg_smp['n_neighs']
 
+        # number of unlabeled samples whose neighbours are searched at once
+        self.chunk_size = 256
+        # maximum number of elements of the (chunk, N_lab, D) intermediates 
+        # of the KL neighbour distances (64 MB in fp32), bounding the chunk size
+        self.kl_chunk_elems = 2 ** 24
+
         # distince function between probabilities: KL Divergence
-        self.dist_func = lambda y_l, y_p: kl_div(y_l.cpu().detach(), y_p.cpu().detach()).sum(1)
+        self.dist_func = lambda y_l, y_p: kl_div(y_l.detach(), y_p.detach()).sum(-1)
+
+        # distance type for finding neighbours (l2, kldiv, sym_kldiv)
+        self.neigh_dist = cfg_smp['neigh_dist']
 
-        # distance function for finding neighbours
-        if cfg_smp['neigh_dist'] == 'l2': # l2 distance
-            self.neigh_dist_func = lambda p, A: torch.sum((p[..., 0] - A[..., 0]) ** 2, axis=1)
+        # distance function for finding neighbours, 
+        # pairwise between the samples p (N_p, D, 2) and the possible neighbours A (N_A, D, 2) -> (N_p, N_A)
+        if cfg_smp['neigh_dist'] == 'l2': # (squared) l2 distance
+            self.neigh_dist_func = lambda p, A: torch.cdist(p[..., 0], A[..., 0]) ** 2
         elif cfg_smp['neigh_dist'] == 'kldiv': # Kl divergence
-            self.neigh_dist_func = lambda p, A: gaussian_kl_div(p[..., 0], p[..., 1], A[..., 0], A[..., 1])
+            self.neigh_dist_func = lambda p, A: gaussian_kl_div(p[:, None, :, 0], p[:, None, :, 1], 
+                                                                A[None, :, :, 0], A[None, :, :, 1])
         elif cfg_smp['neigh_dist'] == 'sym_kldiv': # symmetric KL divergence
-            self.neigh_dist_func = lambda p, A: gaussian_symmetric_kl_div(p[..., 0], p[..., 1], A[..., 0], A[..., 1])
+            self.neigh_dist_func = lambda p, A: gaussian_symmetric_kl_div(p[:, None, :, 0], p[:, None, :, 1], 
+                                                                          A[None, :, :, 0], A[None, :, :, 1])
         else:
             raise ValueError("cfg_smp.neigh_dist set to {} which is not known".format(cfg_smp['neigh_dist']))
 
+        # neighbour search: exact (brute force) or approximate with a FAISS index (only for l2)
+        self.neigh_search = check_neigh_search(cfg_smp, cfg_smp['neigh_dist'])
+
     def sample(self, active_data, acq_size, model):
         """
         Sampling function which returns the best samples according to Contrastive Active Sampling
         It returns the indices in training to be set as labeled which were initially unlabeled.
         """
+        # indices of unlabeled indices in the training (in the order of the unshuffled unlabeled loader)
+        unlbld_idx = active_data.unlbld_idx
 
-        # generating labeled and unlabeled loaders 
+        # generating labeled and unlabeled loaders (unlabeled in order, to match the unlabeled indices)
         labeled_data = active_data.get_loader('labeled', batch_size=self.batch_size)
-        unlabeled_data = active_data.get_loader('unlabeled', batch_size=self.batch_size)
-
-        # initializing the latent space and probability lists for labeled (lab) and unlabeled (unlab)
-        z_lab, p_lab, z_unlab, p_unlab = list(), list(), list(), list()
-
-        for x, _ in labeled_data: # for the labeled samples
-            x = x.to(self.dev) # put input to the device (cpu/gpu)
-            z = model.latent_param(x) # get latent parameters (mean, log variance)
-            z_lab.append(z) # append latent parameters to the list
-            p = model.classify(x) # get the classification result from the model
-            p_lab.append(p) # append output probabilities to the list
-        for x, _ in unlabeled_data: # for the unlabeled samples
-            x = x.to(self.dev) # put input to the device (cpu/gpu)
-            z = model.latent_param(x) # get latent parameters (mean, log variance)
-            z_unlab.append(z) # append latent parameters to the list
-            p = model.classify(x) # get the classification result from the model
-            p_unlab.append(p) # append output probabilities to the list
-
-        # transform lists of latent parameters into torch tensor for labeled and unlabeled
-        z_lab = torch.cat(z_lab) 
-        z_unlab = torch.cat(z_unlab)
-
-        # transform lists of classification probabilities (normalized) into torch tensor for labeled and unlabeled
-        p_lab = normalize(torch.exp(torch.cat(p_lab)), p=1)
-        p_unlab = normalize(torch.exp(torch.cat(p_unlab)), p=1)
-
-        score = torch.zeros((len(p_unlab))) # score tensor initialization
-
-        for i in range(len(p_unlab)): # for each unlabeled sample
+        unlabeled_data = active_data.get_loader('unlabeled', batch_size=self.batch_size, shuffle=False)
+
+        # latent parameters and classification outputs for labeled (lab) and unlabeled (unlab)
+        z_lab, p_lab = self.infer(labeled_data, model)
+        z_unlab, p_unlab = self.infer(unlabeled_data, model)
+
+        # classification probabilities (softmax of logits or log probabilities) for labeled and unlabeled
+        p_lab = p_lab.softmax(dim=1)
+        p_unlab = p_unlab.softmax(dim=1)
+
+        score = torch.empty(len(p_unlab), device=self.dev) # score tensor initialization
+
+        # building the approximate neighbour index once for the labeled samples
+        index = faiss_index(z_lab[..., 0]) if self.neigh_search == 'faiss' else None
+
+        # the KL distances broadcast to (chunk, N_lab, D), hence their chunks shrink as the labeled set grows
+        chunk_size = self.chunk_size
+        if self.neigh_dist != 'l2':
+            chunk_size = min(chunk_size, max(1, self.kl_chunk_elems // z_lab[..., 0].numel()))
+
+        for i in range(0, len(p_unlab), chunk_size): # for each chunk of unlabeled samples
+            chunk = slice(i, i + chunk_size)
             # find the neighbours to be considered in latent space representation
-            idxs_neigh = self.find_neighs(z_unlab[i].unsqueeze(0), z_lab, self.n_neighs)
+            idxs_neigh = self.find_neighs(z_unlab[chunk], z_lab, self.n_neighs, index)
+            # gathering the classification probabilities of the neighbours (len(chunk), K, #classes)
+            p_neigh = torch.index_select(p_lab, 0, idxs_neigh.reshape(-1)).view(*idxs_neigh.shape, -1)
             # calculating the score as the mean distance from the neighbours in classification probability space
-            score[i] = self.dist_func(p_lab[idxs_neigh], p_unlab[i].unsqueeze(0)).mean()
+            score[chunk] = self.dist_func(p_neigh, p_unlab[chunk].unsqueeze(1)).mean(1)
 
-        # finding the best neighbor indices
-        _, querry_indices = torch.topk(score, acq_size) 
-
-        # indices of unlabeled indices in the training
-        unlbld_idx = torch.where(torch.logical_not(active_data.lbld_mask))[0] 
+        # finding the best neighbor indices (order of the selected samples is irrelevant)
+        querry_indices = self.acquire(score, acq_size)
 
         # returning indices in training to be set as labeled which were initially unlabeled
-        return unlbld_idx[querry_indices] 
+        return unlbld_idx[querry_indices.cpu()]
 
-    def find_neighs(self, p, A, n_neigh):
+    def infer(self, data, model):
+        """
+        Returns the latent parameters (mean, log variance) and the classification results 
+        of the model for all samples of the data loader, in the loader order
+        """
+        n_samples = len(data.dataset)
+        z_all, p_all, i = None, None, 0
+
+        with torch.inference_mode(), autocast(self.dev):
+            for x, _ in data:
+                x = x.to(self.dev, non_blocking=True) # put input to the device (cpu/gpu)
+                # get latent parameters and the classification result with a single forward pass
+                z, p = model.latent_param_and_classify(x)
+                if z_all is None: # preallocating on the device after the shapes are known
+                    z_all = torch.empty((n_samples, *z.shape[1:]), device=self.dev)
+                    p_all = torch.empty((n_samples, *p.shape[1:]), device=self.dev)
+                z_all[i:i + len(x)] = z
+                p_all[i:i + len(x)] = p
+                i += len(x)
+
+        return z_all, p_all
+
+    def find_neighs(self, p, A, n_neigh, index=None):
         """
-        An algorithm to find nearest neighbors
+        An algorithm to find nearest neighbors for a batch of samples
         n_neigh : number of neighbours (K), 
-        p       : the sample
+        p       : the samples
         A       : possible neighbours
+        index   : approximate neighbour index built from A (optional)
+        Returns the indices of the neighbours in A with shape (len(p), K)
         """
+        if index is not None: # approximate search
+            _, idxs_neigh = index.search(p[..., 0].detach().cpu().numpy().astype(np.float32), n_neigh)
+            return torch.as_tensor(idxs_neigh, device=A.device)
         dist = self.neigh_dist_func(p, A)
-        return torch.argsort(dist)[:n_neigh]
+        _, idxs_neigh = torch.topk(dist, n_neigh, dim=1, largest=False)
+        return idxs_neigh
 
 class VAALSampler(TrainableSampler):
     """VAAL sampler from https://github.com/sinhasam/vaal"""
@@ -200,27 +291,26 @@ class VAALSampler(TrainableSampler):
         return self.bce_loss(labeled_preds, lab_real_preds) + self.bce_loss(unlabeled_preds, unlab_real_preds)
 
     def sample(self, active_data, acq_size, model):
-        d_pool = active_data.unlabeled_trainset
+        # unlabeled samples in the order of the unlabeled indices (no shuffling)
+        unlabeled_data = active_data.get_loader('unlabeled', batch_size=self.batch_size, shuffle=False)
         all_preds = []
-        # TODO: Also work with batches!
-        pbar = tqdm(d_pool)
+        pbar = tqdm(unlabeled_data)
         pbar.set_description(f"Sampling")
-        for i, xt_p in enumerate(pbar):
-            x = xt_p[0]
-            x = x.to(self.dev)
-            mu = model.latent_param(x.unsqueeze(0))[..., 0]
-            d = self.discriminator(mu)
-            all_preds.append(d)
-
-        all_preds = torch.stack(all_preds).squeeze()
+        with torch.inference_mode(), autocast(self.dev):
+            for x, _ in pbar:
+                x = x.to(self.dev, non_blocking=True)
+                mu = model.latent_param(x)[..., 0]
+                d = self.discriminator(mu)
+                all_preds.append(d.float())
+
+        all_preds = torch.cat(all_preds)
         all_preds = all_preds.view(-1)
         all_preds *= -1
 
         # select the points which the discriminator things are the most likely to be unlabeled
-        _, querry_indices = torch.topk(all_preds, acq_size)
-        unlbld_idx = torch.where(torch.logical_not(active_data.lbld_mask))[0]
+        querry_indices = self.acquire(all_preds, acq_size)
 
-        return unlbld_idx[querry_indices]
+        return active_data.unlbld_idx[querry_indices.cpu()]
 
 
 class Discriminator(nn.Module):
@@ -250,9 +340,16 @@ class CAL_PCA(BaseSampler):
         self.n_neighs = cfg_smp['n_neighs']
         self.n_pca_comp = cfg_smp['n_pca_comp']
 
-        self.dist_func = lambda y_l, y_p: kl_div(y_l.cpu().detach(), y_p.cpu().detach()).sum(1)
+        # neighbour search: exact (brute force) or approximate with a FAISS index
+        self.neigh_search = check_neigh_search(cfg_smp)
 
-        self.neigh_dist_func = lambda p, A: torch.sum((p[...] - A[...]) ** 2, axis=1)
+        # number of unlabeled samples whose neighbours are searched at once
+        self.chunk_size = 256
+
+        self.dist_func = lambda y_l, y_p: kl_div(y_l.detach(), y_p.detach()).sum(-1)
+
+        # pairwise squared l2 distance between the samples p (N_p, D) and the possible neighbours A (N_A, D)
+        self.neigh_dist_func = lambda p, A: torch.cdist(p, A) ** 2
 
 
     def sample(self, active_data, acq_size, model):
@@ -260,72 +357,94 @@ class CAL_PCA(BaseSampler):
         Sampling function which returns the best samples according to Contrastive Active Sampling
         It returns the indices in training to be set as labeled which were initially unlabeled.
         """
-        
-        # Take all the training data for the PCA
-        all_DL = active_data.get_loader('train_all', batch_size=len(active_data.base_trainset))
-        all_iter = iter(all_DL)
-        x_all, _ = next(all_iter)
-        pca = PCA(n_components=self.n_pca_comp)
-        pca_model = pca.fit(torch.reshape(x_all, (len(active_data.base_trainset), -1)))
-        del x_all, _, all_DL, all_iter
-
-        # generating labeled and unlabeled loaders 
-        labeled_data = active_data.get_loader('labeled', batch_size=self.batch_size)
-        unlabeled_data = active_data.get_loader('unlabeled', batch_size=self.batch_size)
-
-        # initializing the latent space and probability lists for labeled (lab) and unlabeled (unlab)
-        z_lab, p_lab, z_unlab, p_unlab = list(), list(), list(), list()
-
-        for x, _ in labeled_data:  # for the labeled samples
-            x = x.to(self.dev) # put input to the device (cpu/gpu)
-            # Project the data to the PCA coordinates
-            z = pca_model.transform(torch.reshape(x.cpu(), (self.batch_size, -1)))
-            z_lab.append(torch.tensor(z, device=self.dev)) # append latent parameters to the list
-            p = model.classify(x) # get the classification result from the model
-            p_lab.append(p) # append output probabilities to the list
-        for x, _ in unlabeled_data: # for the unlabeled samples
-            x = x.to(self.dev) # put input to the device (cpu/gpu)
-            # Project the data to the PCA coordinates
-            z = pca_model.transform(torch.reshape(x.cpu(), (self.batch_size, -1))) 
-            z_unlab.append(torch.tensor(z, device=self.dev)) # append latent parameters to the list
-            p = model.classify(x) # get the classification result from the model
-            p_unlab.append(p) # append output probabilities to the list
-
-
-        # transform lists of latent parameters into torch tensor for labeled and unlabeled
-        z_lab = torch.cat(z_lab) 
-        z_unlab = torch.cat(z_unlab)
-
-        # transform lists of classification probabilities (normalized) into torch tensor for labeled and unlabeled
-        p_lab = normalize(torch.exp(torch.cat(p_lab)), p=1)
-        p_unlab = normalize(torch.exp(torch.cat(p_unlab)), p=1)
-
-        score = torch.zeros((len(p_unlab))) # score tensor initialization
-
-        for i in range(len(p_unlab)): # for each unlabeled sample
+        # indices of unlabeled indices in the training (in the order of the unshuffled unlabeled loader)
+        unlbld_idx = active_data.unlbld_idx
+
+        # PCA projection of all the training data, fitted only once for the dataset 
+        # (kept on the dataset since the samplers are reconstructed in every run)
+        if self.n_pca_comp not in active_data.pca_coords:
+            # Take all the training data (in order) for the PCA
+            all_DL = active_data.get_loader('train_all', batch_size=len(active_data.base_trainset), 
+                                            shuffle=False, cache=False)
+            x_all, _ = next(iter(all_DL))
+            active_data.pca_coords[self.n_pca_comp] = self.fit_pca(x_all.to(self.dev))
+            del x_all, _, all_DL
+
+        # PCA coordinates of the training set, split into labeled and unlabeled (in order)
+        z_train = active_data.pca_coords[self.n_pca_comp][active_data.trainset.indices.to(self.dev)]
+        lbld_mask = active_data.lbld_mask.to(self.dev)
+        z_lab = z_train[lbld_mask]
+        z_unlab = z_train[~lbld_mask]
+
+        # generating labeled and unlabeled loaders (in order, to match the PCA coordinates)
+        labeled_data = active_data.get_loader('labeled', batch_size=self.batch_size, shuffle=False)
+        unlabeled_data = active_data.get_loader('unlabeled', batch_size=self.batch_size, shuffle=False)
+
+        # initializing the probability lists for labeled (lab) and unlabeled (unlab)
+        p_lab, p_unlab = list(), list()
+
+        with torch.inference_mode(), autocast(self.dev):
+            for x, _ in labeled_data:  # for the labeled samples
+                x = x.to(self.dev, non_blocking=True) # put input to the device (cpu/gpu)
+                p = model.classify(x) # get the classification result from the model
+                p_lab.append(p.float()) # append output probabilities to the list
+            for x, _ in unlabeled_data: # for the unlabeled samples
+                x = x.to(self.dev, non_blocking=True) # put input to the device (cpu/gpu)
+                p = model.classify(x) # get the classification result from the model
+                p_unlab.append(p.float()) # append output probabilities to the list
+
+        # transform lists of classification probabilities (softmax of logits or log probabilities) 
+        # into torch tensor for labeled and unlabeled
+        p_lab = torch.cat(p_lab).softmax(dim=1)
+        p_unlab = torch.cat(p_unlab).softmax(dim=1)
+
+        score = torch.empty(len(p_unlab), device=self.dev) # score tensor initialization
+
+        # building the approximate neighbour index once for the labeled samples
+        index = faiss_index(z_lab) if self.neigh_search == 'faiss' else None
+
+        for i in range(0, len(p_unlab), self.chunk_size): # for each chunk of unlabeled samples
+            chunk = slice(i, i + self.chunk_size)
             # find the neighbours to be considered in latent space representation
-            idxs_neigh = self.find_neighs(z_unlab[i].unsqueeze(0), z_lab, self.n_neighs)
+            idxs_neigh = self.find_neighs(z_unlab[chunk], z_lab, self.n_neighs, index)
+            # gathering the classification probabilities of the neighbours (len(chunk), K, #classes)
+            p_neigh = torch.index_select(p_lab, 0, idxs_neigh.reshape(-1)).view(*idxs_neigh.shape, -1)
             # calculating the score as the mean distance from the neighbours in classification probability space
-            score[i] = self.dist_func(p_lab[idxs_neigh], p_unlab[i].unsqueeze(0)).mean()
+            score[chunk] = self.dist_func(p_neigh, p_unlab[chunk].unsqueeze(1)).mean(1)
 
-        # finding the best neighbor indices
-        _, querry_indices = torch.topk(score, acq_size)
-
-        # indices of unlabeled indices in the training
-        unlbld_idx = torch.where(torch.logical_not(active_data.lbld_mask))[0]
+        # finding the best neighbor indices (order of the selected samples is irrelevant)
+        querry_indices = self.acquire(score, acq_size)
 
         # returning indices in training to be set as labeled which were initially unlabeled
-        return unlbld_idx[querry_indices]
+        return unlbld_idx[querry_indices.cpu()]
 
-    def find_neighs(self, p, A, n_neigh):
+    def fit_pca(self, x_all):
+        """
+        Fits the PCA exactly with the eigendecomposition of the (D, D) covariance on the device of the data
+        Returns the projection of the data to the PCA coordinates (N, n_pca_comp)
+        """
+        x_all = x_all.flatten(1)
+        x_all = x_all - x_all.mean(0)
+        # eigenvalues in ascending order, taking the eigenvectors of the largest ones
+        _, eigvecs = torch.linalg.eigh(x_all.T @ x_all)
+        components = eigvecs[:, -self.n_pca_comp:].flip(-1)
+        return x_all @ components
+
+    def find_neighs(self, p, A, n_neigh, index=None):
         """
-        An algorithm to find nearest neighbors
+        An algorithm to find nearest neighbors for a batch of samples
         n_neigh : number of neighbours (K), 
-        p       : the sample
+        p       : the samples
         A       : possible neighbours
+        index   : approximate neighbour index built from A (optional)
+        Returns the indices of the neighbours in A with shape (len(p), K)
         """
+        if index is not None: # approximate search
+            _, idxs_neigh = index.search(p.detach().cpu().numpy().astype(np.float32), n_neigh)
+            return torch.as_tensor(idxs_neigh, device=A.device)
         dist = self.neigh_dist_func(p, A)
-        return torch.argsort(dist)[:n_neigh]
+        _, idxs_neigh = torch.topk(dist, n_neigh, dim=1, largest=False)
+        return idxs_neigh
 
 # dictionary containing sampler classes
 SAMPLER_DICT = {'random': Random, 'cal': CAL, 'cal_pca': CAL_PCA, 'vaal': VAALSampler}
@@ -73,6 +73,10 @@ class ActiveDataset():
 
         self.iter_schedule = self.get_itersch()
 
+        # PCA coordinates of the base training set (for CAL_PCA sampler) keyed by number of components, 
+        # computed once since the base training set does not change
+        self.pca_coords = dict()
+
     def _init_mask(self, init_lbl_ratio, val_ratio):
         if (val_ratio + init_lbl_ratio) > 1.0:
             sys.exit('The validation and initialization ratio sum should be less than 1.0!')
@@ -139,18 +143,31 @@ class ActiveDataset():
         # updating the ratio
         self.lbld_ratio = torch.true_divide(torch.sum(self.lbld_mask), len(self.lbld_mask))
 
-        # updating labeled and unlabeled indices accordingly
-        lbld_idx = torch.where(self.lbld_mask)[0]
-        unlbld_idx = torch.where(torch.logical_not(self.lbld_mask))[0]
+        # updating labeled and unlabeled indices (in training set) accordingly
+        # which are also the orders of unshuffled labeled and unlabeled loaders
+        self.lbld_idx = self.lbld_mask.nonzero(as_tuple=True)[0]
+        self.unlbld_idx = (~self.lbld_mask).nonzero(as_tuple=True)[0]
 
         # constructing subsets 
-        self.labeled_trainset = Subset(self.trainset, lbld_idx)
-        self.unlabeled_trainset = Subset(self.trainset, unlbld_idx)
+        self.labeled_trainset = Subset(self.trainset, self.lbld_idx)
+        self.unlabeled_trainset = Subset(self.trainset, self.unlbld_idx)
+
+        # clearing the cached loaders since the subsets have changed
+        self.loaders = dict()
 
-    def get_loader(self, spec, batch_size, shuffle=True, num_workers=8):
+    def get_loader(self, spec, batch_size, shuffle=True, num_workers=4, cache=True):
         """
         Getting loader according to the desired sub-dataset
+
+        If cache is set, the loader is kept (with persistent workers) and reused for the 
+        same arguments until the labeled and unlabeled subsets are updated.
         """
+        key = (spec.lower(), batch_size, shuffle, num_workers)
+        if cache and key in self.loaders:
+            loader = self.loaders[key]
+            loader.generator.manual_seed(self.seed) # for reproducibility
+            return loader
+
         if spec.lower() == 'train': # training set
             dataset = self.trainset
         elif spec.lower() == 'test': # test set
@@ -170,14 +187,22 @@ class ActiveDataset():
         g = torch.Generator() # for reproducibility
         g.manual_seed(self.seed) # for reproducibility
 
+        # keeping the workers alive and prefetching batches only for the loaders to be reused
+        worker_kwargs = dict(persistent_workers=cache, prefetch_factor=4) if num_workers > 0 else dict()
+
         loader = DataLoader(dataset, 
                             batch_size=batch_size, 
                             shuffle=shuffle,
                             num_workers=num_workers,
+                            pin_memory=torch.cuda.is_available(), # for faster (non-blocking) copies to GPU
                             worker_init_fn=seed_worker, # for reproducibility
-                            generator=g # for reproducibility
+                            generator=g, # for reproducibility
+                            **worker_kwargs
             )
 
+        if cache:
+            self.loaders[key] = loader
+
         return loader
 
     def get_itersch(self, uniform=True, setL=None, setU=None):
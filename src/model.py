@@ -120,6 +120,15 @@ class Net(nn.Module):
         logvar = latent[2]
         return torch.stack([mu, logvar], -1)
 
+    def latent_param_and_classify(self, x):
+        """
+        Returns the mean and logvar of the latent variable and the classification result
+        using a single forward pass
+        """
+        latent, _, c = self.forward(x, reconstruct=False)
+        mu = latent[1]
+        logvar = latent[2]
+        return torch.stack([mu, logvar], -1), c
 
     def reconstruct(self, x):
         """
@@ -11,11 +11,12 @@ Aron Schmied (aronsch@student.ethz.ch)
 Guney Tombak (gtombak@student.ethz.ch)  
 """
 
+from itertools import islice
 from tqdm import tqdm
 import wandb
 import torch
-from copy import deepcopy
 from src.training_utils import visualize_latent
+from src.base_models.model_utils import autocast
 
 
 def run(model, sampler, active_dataset, run_no, model_writer, cfg):
@@ -25,6 +26,12 @@ def run(model, sampler, active_dataset, run_no, model_writer, cfg):
     acc_best_valid = -1 # highest accuracy initializer
     loss_best_valid = 1e10 # lowest accuracy initializer
 
+    # parameters of the best models (kept in memory, written to disk at the end of the run)
+    state_dict_best_acc, state_dict_best_loss = None, None
+
+    # gradient scaler for mixed precision training (enabled only on GPU)
+    scaler = torch.amp.GradScaler('cuda', enabled=(torch.device(cfg.device).type == 'cuda'))
+
     for epoch_no in pbar: 
         train_loss_dict = train_epoch( # training of epoch
             model, # model to train
@@ -32,7 +39,8 @@ def run(model, sampler, active_dataset, run_no, model_writer, cfg):
             active_dataset, # dataset to be used
             batch_size=cfg.batch_size,
             device=cfg.device,
-            train_vae=cfg.embedding['train_vae']
+            train_vae=cfg.embedding['train_vae'],
+            scaler=scaler
         )
         valid_loss_dict, valid_acc = validate_epoch( # evaluating the model success
             model, # model to assess accuracy/loss
@@ -56,26 +64,31 @@ def run(model, sampler, active_dataset, run_no, model_writer, cfg):
 
         wandb.log(wandb_data)
 
-        # save the model if it has higher validation accuracy of all epochs with prefix best_acc_ 
+        # keep the model if it has higher validation accuracy of all epochs
         if valid_acc > acc_best_valid:
-            model_writer.write(model, 'best_acc_') # saving model parameters to
-            # save/param/<date>_<experiment_name>_<seed>_<W&B_ID>/best_acc_weights.pth
+            state_dict_best_acc = state_dict_snapshot(model) # keeping model parameters in memory
             acc_best_valid = valid_acc # defining new highest accuracy
 
-        # save the model if it has lower validation loss of all epochs with prefix best_loss_
+        # keep the model if it has lower validation loss of all epochs
         if valid_loss_dict['classification_loss_val'] < loss_best_valid:
-            model_writer.write(model, 'best_loss_') # saving model parameters to 
-            # save/param/<date>_<experiment_name>_<seed>_<W&B_ID>/best_loss_weights.pth
+            state_dict_best_loss = state_dict_snapshot(model) # keeping model parameters in memory
             loss_best_valid = valid_loss_dict['classification_loss_val'] # defining new lowest loss
 
+    # saving the best model parameters with prefixes best_acc_ and best_loss_ to
+    # save/param/<date>_<experiment_name>_<seed>_<W&B_ID>/best_<acc/loss>_weights.pth
+    if state_dict_best_acc is not None:
+        model_writer.write_state_dict(state_dict_best_acc, 'best_acc_')
+    if state_dict_best_loss is not None:
+        model_writer.write_state_dict(state_dict_best_loss, 'best_loss_')
+
     # in the end of the run, three types of test accuracy is calculated with the parameters of
     # 1) last epoch, best validation accuracy, best validation loss
     test_acc_last_epoch = test_epoch(model, active_dataset, batch_size=cfg.batch_size, 
-                                     device=cfg.device, model_writer=model_writer)
+                                     device=cfg.device)
     test_acc_best_acc = test_epoch(model, active_dataset, batch_size=cfg.batch_size, 
-                                   device=cfg.device, model_writer=model_writer, load_prefix='best_acc_')
+                                   device=cfg.device, state_dict=state_dict_best_acc)
     test_acc_best_loss = test_epoch(model, active_dataset, batch_size=cfg.batch_size, 
-                                    device=cfg.device, model_writer=model_writer, load_prefix='best_loss_')
+                                    device=cfg.device, state_dict=state_dict_best_loss)
     wandb.log({ "test_acc_last_epoch"   : test_acc_last_epoch, 
                 "test_acc_best_acc"     : test_acc_best_acc,
                 "test_acc_best_loss"    : test_acc_best_loss,
@@ -85,7 +98,26 @@ def run(model, sampler, active_dataset, run_no, model_writer, cfg):
         # save/results/<experiment_name>/latent_visual_mu_<logvar>_<run_no>
         visualize_latent(model, active_dataset, cfg, run_no)
 
-def train_epoch(model, sampler, active_data, batch_size, device, train_vae=True):
+def state_dict_snapshot(model):
+    """Copy of the model parameters in (CPU) memory"""
+    return {k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items()}
+
+def mean_loss(loss_sum, n):
+    """Mean of the accumulated losses (nan for no losses, as the mean of an empty tensor)"""
+    return (loss_sum / n).item() if n > 0 else float('nan')
+
+def backward_step(loss, optimizer, scaler):
+    """Backpropagation and step with the gradient scaler of mixed precision training"""
+    optimizer.zero_grad()
+    scaler.scale(loss).backward()
+    scaler.step(optimizer)
+    scaler.update()
+
+def train_epoch(model, sampler, active_data, batch_size, device, train_vae=True, scaler=None):
+
+    # gradient scaler for mixed precision training (disabled: plain backpropagation and step)
+    if scaler is None:
+        scaler = torch.amp.GradScaler('cuda', enabled=False)
 
     # enabling the training mode
     model.train()
@@ -107,9 +139,10 @@ def train_epoch(model, sampler, active_data, batch_size, device, train_vae=True)
     # calculating number of iterations needed
     n_iters = len(active_data.trainset) // batch_size
 
-    # lists for losses: classification, reconstruction, 
+    # sums (on device, to avoid synchronization) and counts of losses: classification, reconstruction, 
     # generative and discriminative sampler (VAAL sampler)
-    c_losses, r_losses, se_losses, ss_losses = list(), list(), list(), list()
+    c_sum, r_sum, se_sum, ss_sum = [torch.zeros((), device=device) for _ in range(4)]
+    c_n, r_n, se_n, ss_n = 0, 0, 0, 0
 
     # setting the progress bar
     pbar = tqdm(iter_schedule[:n_iters], leave=False)
@@ -122,34 +155,35 @@ def train_epoch(model, sampler, active_data, batch_size, device, train_vae=True)
                 continue
 
             # transforming data to device and classify
-            x = x.to(device)
-            t = t.to(device)
-            c = model.classify(x)
+            x = x.to(device, non_blocking=True)
+            t = t.to(device, non_blocking=True)
+            with autocast(device):
+                c = model.classify(x)
 
-            # computing classification loss
-            loss = model.c_loss(c, t)
-            c_losses.append(float(loss))
+                # computing classification loss
+                loss = model.c_loss(c, t)
+            c_sum += loss.detach()
+            c_n += 1
 
             # backpropagation and step
-            model.optimizer_classifier.zero_grad()
-            loss.backward()
-            model.optimizer_classifier.step()
+            backward_step(loss, model.optimizer_classifier, scaler)
 
             if train_vae: # if VAE is trainable
                 if sampler.trainable:
                     x_unlabeled, _ = next(unlbl_iter)
-                    x_unlabeled = x_unlabeled.to(device)
-                    mu_labeled = model.latent_param(x_unlabeled)[..., 0]
-                    mu_unlabeled = model.latent_param(x_unlabeled)[..., 0]
-                    sampler_in = (mu_labeled, mu_unlabeled)
+                    x_unlabeled = x_unlabeled.to(device, non_blocking=True)
+                    with autocast(device):
+                        mu_labeled = model.latent_param(x)[..., 0]
+                        mu_unlabeled = model.latent_param(x_unlabeled)[..., 0]
+                    # sampler in full precision (binary cross entropy is not autocast safe)
+                    sampler_in = (mu_labeled.float(), mu_unlabeled.float())
                     sampler_out = sampler(sampler_in)
                     loss = sampler.model_loss(sampler_out)
-                    se_losses.append(float(loss))
+                    se_sum += loss.detach()
+                    se_n += 1
 
                     # backpropagation and step
-                    model.optimizer_embedding.zero_grad()
-                    loss.backward()
-                    model.optimizer_embedding.step()
+                    backward_step(loss, model.optimizer_embedding, scaler)
         else:
             if train_vae: # if the sample is unlabeled
                 try: # the iteration schedule sometimes become longer than expected
@@ -158,17 +192,17 @@ def train_epoch(model, sampler, active_data, batch_size, device, train_vae=True)
                     continue
 
                 # transforming data to device and reconstruct
-                x = x.to(device)
-                r, latent = model.reconstruct(x)
+                x = x.to(device, non_blocking=True)
+                with autocast(device):
+                    r, latent = model.reconstruct(x)
 
-                # computing reconstruction loss
-                loss = model.r_loss(r.flatten(), x.flatten(), *latent[1:])['loss']
-                r_losses.append(float(loss))
+                    # computing reconstruction loss
+                    loss = model.r_loss(r.flatten(), x.flatten(), *latent[1:])['loss']
+                r_sum += loss.detach()
+                r_n += 1
 
                 # backpropagation and step
-                model.optimizer_embedding.zero_grad()
-                loss.backward()
-                model.optimizer_embedding.step()
+                backward_step(loss, model.optimizer_embedding, scaler)
 
     # sampler (discriminator) is trained separately (unlike vaal) from generator (as suggested for GAN)
     if sampler.trainable:
@@ -176,108 +210,133 @@ def train_epoch(model, sampler, active_data, batch_size, device, train_vae=True)
         lbld_DL = active_data.get_loader('labeled', batch_size=batch_size)
         unlbld_DL = active_data.get_loader('unlabeled', batch_size=batch_size)
 
+        # number of steps in each sub epoch and number of batches used in all sub epochs
+        n_steps = min(len(lbld_DL), len(unlbld_DL))
+        n_batches = sampler.n_sub_epochs * n_steps
+
+        # latent means of the labeled and unlabeled samples used by the sub epochs, computed only once 
+        # since the VAE is not updated during the sampler training
+        # (no_grad instead of inference_mode, since they are inputs of the sampler training)
+        with torch.no_grad(), autocast(device):
+            mu_lbld = torch.cat([model.latent_param(x.to(device, non_blocking=True))[..., 0] 
+                                 for x, _ in islice(lbld_DL, n_batches)])
+            mu_unlbld = torch.cat([model.latent_param(x.to(device, non_blocking=True))[..., 0] 
+                                   for x, _ in islice(unlbld_DL, n_batches)])
+        # sampler in full precision (binary cross entropy is not autocast safe)
+        mu_lbld, mu_unlbld = mu_lbld.float(), mu_unlbld.float()
+
         sampler.train()
         pbar_sub_ep = tqdm(range(sampler.n_sub_epochs), leave=False)
         for _ in pbar_sub_ep:
-            lbl_iter = iter(lbld_DL)
-            unlbl_iter = iter(unlbld_DL)
-            pbar_step = tqdm(range(min(len(lbl_iter), len(unlbl_iter))), leave=False)
+            # shuffling the latent means in every sub epoch
+            perm_lbld = torch.randperm(len(mu_lbld), device=mu_lbld.device)
+            perm_unlbld = torch.randperm(len(mu_unlbld), device=mu_unlbld.device)
+            pbar_step = tqdm(range(n_steps), leave=False)
             pbar.set_description("sampler epoch")
-            for _ in pbar_step:
-                x_labeled, _ = next(lbl_iter)
-                x_unlabeled, _ = next(unlbl_iter)
-                x_labeled = x_labeled.to(device)
-                x_unlabeled = x_unlabeled.to(device)
-
-                mu_labeled = model.latent_param(x_labeled)[..., 0]
-                mu_unlabeled = model.latent_param(x_unlabeled)[..., 0]
+            sampler.optimizer.zero_grad()
+            for step in pbar_step:
+                batch = slice(step * batch_size, (step + 1) * batch_size)
+                mu_labeled = mu_lbld[perm_lbld[batch]]
+                mu_unlabeled = mu_unlbld[perm_unlbld[batch]]
 
                 sampler_in = (mu_labeled, mu_unlabeled)
                 sampler_out = sampler(sampler_in)
                 loss = sampler.sampler_loss(sampler_out)
-                ss_losses.append(float(loss))
+                ss_sum += loss.detach()
+                ss_n += 1
 
-                # backpropagation and step
-                sampler.optimizer.zero_grad()
-                loss.backward()
-                sampler.optimizer.step()
+                # backpropagation with gradient accumulation, step after every n_accum_steps
+                scaler.scale(loss / sampler.n_accum_steps).backward()
+                if (step + 1) % sampler.n_accum_steps == 0 or (step + 1) == n_steps:
+                    scaler.step(sampler.optimizer)
+                    scaler.update()
+                    sampler.optimizer.zero_grad()
 
     # log the training losses
     result = {
-        'classification_loss_train': torch.mean(torch.tensor(c_losses)),
-        'reconstruction_loss_train': torch.mean(torch.tensor(r_losses)),
-        'sampling_embedding_loss_train': torch.mean(torch.tensor(se_losses)),
-        'sampling_sampler_loss_train': torch.mean(torch.tensor(ss_losses))
+        'classification_loss_train': mean_loss(c_sum, c_n),
+        'reconstruction_loss_train': mean_loss(r_sum, r_n),
+        'sampling_embedding_loss_train': mean_loss(se_sum, se_n),
+        'sampling_sampler_loss_train': mean_loss(ss_sum, ss_n)
     }
 
     return result
 
         
+@torch.inference_mode()
 def validate_epoch(model, active_data, batch_size, device, train_vae=True):
 
     # enabling evaluation mode
     model.eval()
-    torch.set_grad_enabled(False)
 
     # getting validation dataset data loader
     valid_DL = active_data.get_loader('validation', batch_size=batch_size)
 
-    
-    c_losses, r_losses = list(), list()
+    # sums (on device) and counts of classification and reconstruction losses
+    c_sum, r_sum = torch.zeros((), device=device), torch.zeros((), device=device)
+    c_n, r_n = 0, 0
 
-    # setting counters for validation accuracy
-    correct, total = 0, 0
+    # setting counters for validation accuracy (true guesses on device)
+    correct, total = torch.zeros((), dtype=torch.long, device=device), 0
 
     # count number of true guesses
     for x, t in valid_DL:
-        x = x.to(device)
-        t = t.to(device)
-        c = model.classify(x)
-        loss = model.c_loss(c, t)
-        c_losses.append(loss)
+        x = x.to(device, non_blocking=True)
+        t = t.to(device, non_blocking=True)
+        # classification and (if VAE is trainable) reconstruction sharing the encoder pass
+        with autocast(device):
+            latent, r, c = model(x, reconstruct=train_vae)
+            loss = model.c_loss(c, t)
+        c_sum += loss
+        c_n += 1
 
         correct += (c.argmax(1) == t).sum()
         total += len(t)
 
         if train_vae: # if VAE is trainable, log the loss
-            r, latent = model.reconstruct(x)
-            loss = model.r_loss(r.flatten(), x.flatten(), *latent[1:])['loss']
-            r_losses.append(loss)
+            with autocast(device):
+                loss = model.r_loss(r.flatten(), x.flatten(), *latent[1:])['loss']
+            r_sum += loss
+            r_n += 1
 
     # return classification and reconstruction losses with accuracy
     result = {
-        'classification_loss_val': torch.mean(torch.tensor(c_losses)),
-        'reconstruction_loss_val': torch.mean(torch.tensor(r_losses)),
+        'classification_loss_val': mean_loss(c_sum, c_n),
+        'reconstruction_loss_val': mean_loss(r_sum, r_n),
     }
-    return result, torch.true_divide(correct, total) * 100
+    return result, (correct / total * 100).item()
 
 
-def test_epoch(model_actual, active_data, batch_size, device, model_writer, load_prefix=None):
+def test_epoch(model, active_data, batch_size, device, state_dict=None):
     # constructing dataset loader for testing
     test_DL = active_data.get_loader('test', batch_size=batch_size)
 
-    # copying model to not change the parameters of the main by loading
-    model = deepcopy(model_actual)
-
-    if load_prefix is not None: # loading model parameters
-        model_writer.load(model, prefix=load_prefix)
+    if state_dict is not None: # loading model parameters
+        # keeping the current parameters to not change the main model by loading
+        state_dict_actual = {k: v.detach().clone() for k, v in model.state_dict().items()}
+        model.load_state_dict(state_dict)
 
-    # enabling evaluation mode
-    model.eval()
-    torch.set_grad_enabled(False)
+    try:
+        # enabling evaluation mode
+        model.eval()
+        torch.set_grad_enabled(False)
 
-    # setting counters for test accuracy
-    correct, total = 0, 0
+        # setting counters for test accuracy (true guesses on device)
+        correct, total = torch.zeros((), dtype=torch.long, device=device), 0
 
-    # count number of true guesses
-    for x, t in test_DL:
-        x = x.to(device)
-        t = t.to(device)
-        c = model.classify(x)
+        # count number of true guesses
+        for x, t in test_DL:
+            x = x.to(device, non_blocking=True)
+            t = t.to(device, non_blocking=True)
+            with autocast(device):
+                c = model.classify(x)
 
-        correct += (c.argmax(1) == t).sum()
-        total += len(t)
+            correct += (c.argmax(1) == t).sum()
+            total += len(t)
+    finally:
+        if state_dict is not None: # restoring the parameters of the main model
+            model.load_state_dict(state_dict_actual)
 
     # return accuracy
-    return correct / total * 100
+    return (correct / total * 100).item()
 
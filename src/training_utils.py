@@ -63,7 +63,7 @@ def visualize_latent(model, active_dataset, cfg, run_no, verbose=0):
     nr_of_samples = 2500
     device = cfg.device
 
-    all_DL = active_dataset.get_loader('train', batch_size=nr_of_samples, shuffle=True)
+    all_DL = active_dataset.get_loader('train', batch_size=nr_of_samples, shuffle=True, cache=False)
     all_iter = iter(all_DL)
     x, y = next(all_iter)
     x = x.to(device)
@@ -173,10 +173,8 @@ class ModelWriter():
 
     def write(self, model, prefix=''):
         # https://pytorch.org/tutorials/beginner/saving_loading_models.html
-        torch.save(model.state_dict(), self.dir + prefix + 'weights.pth')
+        self.write_state_dict(model.state_dict(), prefix)
 
-    def load(self, model, prefix=''):
-        # https://pytorch.org/tutorials/beginner/saving_loading_models.html
-        model.load_state_dict(torch.load(self.dir + prefix + 'weights.pth'))
-        return model
+    def write_state_dict(self, state_dict, prefix=''):
+        torch.save(state_dict, self.dir + prefix + 'weights.pth')
         
\ No newline at end of file